@@ -36,7 +36,6 @@ setup(
     ]},
     install_requires=[
         'click>=7.1.2',
-        'psutil>=5.7.0',
     ],
     packages=find_packages(),
     python_requires='>=3.6, <4',
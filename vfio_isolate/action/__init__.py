@@ -5,5 +5,8 @@ from .cpuset_create import CPUSetCreate
 from .cpuset_delete import CPUSetDelete
 from .cpuset_modify import CPUSetModify
 from .drop_caches import DropCaches
-from .irq_affinity import IRQAffinityOperation, IRQAffinity
+from .irq_affinity import IRQAffinityOperation, IRQAffinity, IRQAffinityBatch
+from .kthread_affinity import KThreadAffinity
 from .move_tasks import MoveTasks
+from .move_threads import MoveThreads
+from .workqueue_affinity import WorkqueueAffinity
@@ -8,11 +8,12 @@ class CPUSetCreate(Action):
     @dataclass
     class Param:
         cpuset_name: str
+        threaded: bool = False
 
     @classmethod
     def execute(cls, p: Param):
         cpu_set = CPUSet(p.cpuset_name)
-        cpu_set.create()
+        cpu_set.create(threaded=p.threaded)
 
     @classmethod
     def record_undo(cls, p):
@@ -12,7 +12,10 @@ class CPUSetDelete(Action):
     @classmethod
     def execute(cls, p: Param):
         cpu_set = CPUSet(p.cpuset_name)
-        cpu_set.parent().add_all_from_cpuset(cpu_set)
+        if cpu_set.is_threaded():
+            cpu_set.parent().add_tids(cpu_set.tids())
+        else:
+            cpu_set.parent().add_all_from_cpuset(cpu_set)
         cpu_set.remove()
 
     @classmethod
@@ -20,11 +23,12 @@ class CPUSetDelete(Action):
         from .cpuset_create import CPUSetCreate
         from .cpuset_modify import CPUSetModify
 
+        cpu_set = CPUSet(p.cpuset_name)
         yield Execution(CPUSetCreate, CPUSetCreate.Param(
-            cpuset_name=p.cpuset_name
+            cpuset_name=p.cpuset_name,
+            threaded=cpu_set.is_threaded()
         ))
 
-        cpu_set = CPUSet(p.cpuset_name)
         yield Execution(CPUSetModify, CPUSetModify.Param(
             cpuset_name=p.cpuset_name,
             cpus=cpu_set.get_cpus(),
@@ -32,5 +36,7 @@ class CPUSetDelete(Action):
             cpu_exclusive=cpu_set.get_cpu_exclusive(),
             mem_exclusive=cpu_set.get_mem_exclusive(),
             mem_migrate=cpu_set.get_mem_migrate(),
-            sched_load_balance=cpu_set.get_sched_load_balance()
+            sched_load_balance=cpu_set.get_sched_load_balance(),
+            partition=cpu_set.get_partition(),
+            exclusive_cpus=cpu_set.get_exclusive_cpus()
         ))
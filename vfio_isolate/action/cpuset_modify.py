@@ -14,12 +14,21 @@ class CPUSetModify(Action):
         mem_exclusive: bool
         mem_migrate: bool
         sched_load_balance: bool
+        partition: str = None
+        exclusive_cpus: CPUNodeSet = None
 
     @classmethod
     def execute(cls, p: Param):
         cpu_set = CPUSet(p.cpuset_name)
+        # a partition root is dissolved before its CPUs change, and set up after
+        if p.partition == "member":
+            cpu_set.set_partition(p.partition)
         if p.cpus is not None:
             cpu_set.set_cpus(p.cpus)
+        if p.exclusive_cpus is not None:
+            cpu_set.set_exclusive_cpus(p.exclusive_cpus)
+        if p.partition is not None and p.partition != "member":
+            cpu_set.set_partition(p.partition)
         if p.mems is not None:
             cpu_set.set_mems(p.mems)
         if p.cpu_exclusive is not None:
@@ -41,5 +50,7 @@ class CPUSetModify(Action):
             cpu_exclusive=cpu_set.get_cpu_exclusive(),
             mem_exclusive=cpu_set.get_mem_exclusive(),
             mem_migrate=cpu_set.get_mem_migrate(),
-            sched_load_balance=cpu_set.get_sched_load_balance()
+            sched_load_balance=cpu_set.get_sched_load_balance(),
+            partition=cpu_set.get_partition() if p.partition is not None else None,
+            exclusive_cpus=cpu_set.get_exclusive_cpus() if p.exclusive_cpus is not None else None
         ))
@@ -1,8 +1,10 @@
+from array import array
 from dataclasses import dataclass
 from enum import Enum, unique
 
 from vfio_isolate.cpuset import CPUNodeSet
-from vfio_isolate.irq import IRQ
+from vfio_isolate.irq import IRQ, IRQS
+from vfio_isolate.output import print_verbose
 from .action import Action, Execution
 
 
@@ -10,9 +12,11 @@ from .action import Action, Execution
 class IRQAffinityOperation(Enum):
     mask = 1,
     add = 2
+    set = 3
 
 
 class IRQAffinity(Action):
+    # a single IRQ, superseded by IRQAffinityBatch, kept to restore older undo files
     @dataclass
     class Param:
         irq: IRQ
@@ -21,14 +25,17 @@ class IRQAffinity(Action):
 
     @classmethod
     def execute(cls, p: Param):
+        # set_affinity skips the write if the affinity does not change
         if p.irq.exists():
             if p.operation == IRQAffinityOperation.add:
-                p.irq.set_affinity(p.irq.get_affinity().union(p.cpus))
+                p.irq.set_affinity(p.irq.get_affinity() | p.cpus)
+            elif p.operation == IRQAffinityOperation.set:
+                p.irq.set_affinity(p.cpus)
             elif p.operation == IRQAffinityOperation.mask:
-                remaining = p.irq.get_affinity().intersection(p.cpus.negation())
+                remaining = p.irq.get_affinity() & ~p.cpus
                 if not remaining:
                     # empty: set all but the masked ones
-                    p.irq.set_affinity(p.cpus.negation())
+                    p.irq.set_affinity(~p.cpus)
                 else:
                     # not empty: set
                     p.irq.set_affinity(remaining)
@@ -36,26 +43,79 @@ class IRQAffinity(Action):
     @classmethod
     def record_undo(cls, p: Param):
         if p.irq.exists():
+            affinity = p.irq.get_affinity()
             if p.operation == IRQAffinityOperation.add:
-                added = p.irq.get_affinity().negation().intersection(p.cpus)
+                added = ~affinity & p.cpus
                 if added:
                     yield Execution(IRQAffinity, IRQAffinity.Param(
                         irq=p.irq,
                         operation=IRQAffinityOperation.mask,
                         cpus=added
                     ))
+            elif p.operation == IRQAffinityOperation.set:
+                if affinity != p.cpus:
+                    yield Execution(IRQAffinity, IRQAffinity.Param(
+                        irq=p.irq,
+                        operation=IRQAffinityOperation.set,
+                        cpus=affinity
+                    ))
             elif p.operation == IRQAffinityOperation.mask:
-                masked = p.irq.get_affinity().intersection(p.cpus)
+                masked = affinity & p.cpus
                 if masked:
                     yield Execution(IRQAffinity, IRQAffinity.Param(
                         irq=p.irq,
                         operation=IRQAffinityOperation.add,
                         cpus=masked
                     ))
-                    if masked == p.irq.get_affinity():
+                    if masked == affinity:
                         # would mask all, remove all but the masked ones
                         yield Execution(IRQAffinity, IRQAffinity.Param(
                             irq=p.irq,
                             operation=IRQAffinityOperation.mask,
-                            cpus=p.cpus.negation().intersection(masked.negation())
+                            cpus=~p.cpus & ~masked
                         ))
+
+
+class IRQAffinityBatch(Action):
+    @dataclass
+    class Param:
+        irqs: array
+        operation: IRQAffinityOperation = None
+        cpus: CPUNodeSet = None
+        # affinity bitmaps to set, one per IRQ, instead of operation and cpus (used for undo)
+        masks: list = None
+
+    @classmethod
+    def plan(cls, p: Param):
+        # (irqs, current masks, new masks) of the IRQs whose affinity changes
+        snapshot = IRQS.snapshot()
+        irqs = [irq for irq in p.irqs if irq in snapshot]
+        current = [snapshot.affinity[snapshot.index[irq]] for irq in irqs]
+        if p.masks is not None:
+            masks = dict(zip(p.irqs, p.masks))
+            new = [masks[irq] for irq in irqs]
+        elif p.operation == IRQAffinityOperation.add:
+            cpus = p.cpus.bits
+            new = [bits | cpus for bits in current]
+        elif p.operation == IRQAffinityOperation.set:
+            new = [p.cpus.bits] * len(current)
+        else:
+            # empty: set all but the masked ones
+            inverse = (~p.cpus).bits
+            new = [bits & inverse or inverse for bits in current]
+        changed = [n for n in range(len(irqs)) if current[n] != new[n]]
+        return (array("i", [irqs[n] for n in changed]),
+                [current[n] for n in changed],
+                [new[n] for n in changed])
+
+    @classmethod
+    def execute(cls, p: Param):
+        irqs, _, new = cls.plan(p)
+        changed = IRQS.set_affinities(irqs, new)
+        print_verbose(f"changed the affinity of {changed} of {len(p.irqs)} IRQs")
+
+    @classmethod
+    def record_undo(cls, p: Param):
+        irqs, current, _ = cls.plan(p)
+        if irqs:
+            yield Execution(IRQAffinityBatch, IRQAffinityBatch.Param(irqs=irqs, masks=current))
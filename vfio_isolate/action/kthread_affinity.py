@@ -0,0 +1,45 @@
+from array import array
+from dataclasses import dataclass
+
+from vfio_isolate.kthread import KThreads
+from vfio_isolate.nodeset import CPUNodeSet
+from vfio_isolate.output import print_verbose
+from .action import Action, Execution
+
+
+class KThreadAffinity(Action):
+    @dataclass
+    class Param:
+        cpus: CPUNodeSet = None
+        # previous affinity bitmap -> kernel threads to restore it for (used for undo)
+        affinities: dict = None
+
+    @classmethod
+    def plan(cls, p: Param):
+        # (pids, current masks, new masks) of the kernel threads whose affinity changes
+        snapshot = KThreads.snapshot()
+        if p.affinities is not None:
+            targets = [(pid, bits) for bits, pids in p.affinities.items() for pid in pids if pid in snapshot]
+        else:
+            targets = [(pid, p.cpus.bits) for pid in snapshot.pids]
+        changed = [(pid, snapshot.affinity[snapshot.index[pid]], bits) for pid, bits in targets
+                   if snapshot.affinity[snapshot.index[pid]] != bits]
+        return (array("i", [pid for pid, _, _ in changed]),
+                [current for _, current, _ in changed],
+                [new for _, _, new in changed])
+
+    @classmethod
+    def execute(cls, p: Param):
+        pids, _, new = cls.plan(p)
+        changed = KThreads.set_affinities(pids, new)
+        print_verbose(f"changed the affinity of {changed} of {len(KThreads.snapshot())} kernel threads")
+
+    @classmethod
+    def record_undo(cls, p: Param):
+        # kernel threads usually share a handful of masks, they are grouped by them
+        pids, current, _ = cls.plan(p)
+        affinities = {}
+        for pid, bits in zip(pids, current):
+            affinities.setdefault(bits, array("i")).append(pid)
+        if affinities:
+            yield Execution(KThreadAffinity, KThreadAffinity.Param(affinities=affinities))
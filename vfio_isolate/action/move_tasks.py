@@ -1,6 +1,7 @@
 from dataclasses import dataclass
 
 from vfio_isolate.cpuset import CPUSet
+from vfio_isolate.output import print_debug, print_error
 from .action import Action, Execution
 
 
@@ -9,13 +10,48 @@ class MoveTasks(Action):
     class Param:
         cpuset_from: str
         cpuset_to: str
+        converge: bool = False
+        max_rounds: int = 10
+        freeze: bool = False
+        recursive: bool = False
+        # cpuset name -> pids to move back there, if they are still in cpuset_from (used for undo)
+        pids: dict = None
 
     @classmethod
     def execute(cls, p: Param):
         set_from = CPUSet(p.cpuset_from)
         set_to = CPUSet(p.cpuset_to)
-        set_to.add_all_from_cpuset(set_from)
+        max_rounds = p.max_rounds if p.converge else 1
+        if p.pids is not None:
+            # read once for all cpusets, pids that exit in between fail as exited
+            remaining = set(set_from.pids())
+            for name, pids in p.pids.items():
+                target = CPUSet(name).nearest_existing()
+                if target.name() != name:
+                    print_error(f"warning: CPUSet {name} is gone, moving its tasks to {target.name()}")
+                target.add_pids([pid for pid in pids if pid in remaining])
+        elif p.recursive:
+            set_to.add_all_from_subtree(set_from, max_rounds=max_rounds, freeze=p.freeze)
+        else:
+            set_to.add_all_from_cpuset(set_from, max_rounds=max_rounds, freeze=p.freeze)
 
     @classmethod
     def record_undo(cls, p):
-        yield Execution(MoveTasks, MoveTasks.Param(cpuset_from=p.cpuset_to, cpuset_to=p.cpuset_from))
+        if p.recursive:
+            # every task goes back to the cpuset it came from, or its closest ancestor if that is gone
+            pids = {}
+            for cpuset in CPUSet(p.cpuset_from).subtree(exclude=CPUSet(p.cpuset_to)):
+                try:
+                    cpuset_pids = cpuset.pids()
+                except FileNotFoundError:
+                    print_debug(f"CPUSet {cpuset.name()} vanished")
+                    continue
+                if cpuset_pids:
+                    pids[cpuset.name()] = cpuset_pids
+            if pids:
+                yield Execution(MoveTasks, MoveTasks.Param(cpuset_from=p.cpuset_to, cpuset_to=p.cpuset_from,
+                                                           pids=pids))
+        else:
+            # never freeze on the way back: the destination usually holds whatever runs the restore
+            yield Execution(MoveTasks, MoveTasks.Param(cpuset_from=p.cpuset_to, cpuset_to=p.cpuset_from,
+                                                       converge=p.converge, max_rounds=p.max_rounds))
@@ -0,0 +1,34 @@
+from array import array
+from dataclasses import dataclass
+
+from vfio_isolate.cpuset import CPUSet
+from .action import Action, Execution
+
+
+class MoveThreads(Action):
+    @dataclass
+    class Param:
+        cpuset_to: str
+        tids: array
+        # only move the threads still in this cpuset (used for undo)
+        cpuset_from: str = None
+
+    @classmethod
+    def execute(cls, p: Param):
+        tids = p.tids
+        if p.cpuset_from is not None:
+            remaining = set(CPUSet(p.cpuset_from).tids())
+            tids = [tid for tid in tids if tid in remaining]
+        CPUSet(p.cpuset_to).add_tids(tids)
+
+    @classmethod
+    def record_undo(cls, p: Param):
+        # every thread goes back to the cpuset it came from
+        sources = {}
+        for tid in p.tids:
+            cpuset = CPUSet.of_task(tid)
+            if cpuset is not None:
+                sources.setdefault(cpuset.name(), array("i")).append(tid)
+        for name, tids in sources.items():
+            if name != CPUSet(p.cpuset_to).name():
+                yield Execution(MoveThreads, MoveThreads.Param(cpuset_to=name, tids=tids, cpuset_from=p.cpuset_to))
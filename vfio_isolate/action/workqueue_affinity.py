@@ -0,0 +1,27 @@
+from dataclasses import dataclass
+
+from vfio_isolate.nodeset import CPUNodeSet
+from vfio_isolate.workqueue import Workqueue
+from .action import Action, Execution
+
+
+class WorkqueueAffinity(Action):
+    @dataclass
+    class Param:
+        workqueue: Workqueue
+        cpus: CPUNodeSet
+
+    @classmethod
+    def execute(cls, p: Param):
+        if p.workqueue.exists() and p.workqueue.get_cpumask() != p.cpus:
+            p.workqueue.set_cpumask(p.cpus)
+
+    @classmethod
+    def record_undo(cls, p: Param):
+        if p.workqueue.exists():
+            cpumask = p.workqueue.get_cpumask()
+            if cpumask != p.cpus:
+                yield Execution(WorkqueueAffinity, WorkqueueAffinity.Param(
+                    workqueue=p.workqueue,
+                    cpus=cpumask
+                ))
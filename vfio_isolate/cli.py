@@ -1,14 +1,19 @@
 import pickle
+import re
 import sys
+from array import array
 from dataclasses import is_dataclass
 
 import click
 
+from vfio_isolate import expression
 from vfio_isolate.action import *
 from vfio_isolate.cpu import CPU
+from vfio_isolate.cpuset import CPUSet, process_threads
 from vfio_isolate.irq import IRQS
-from vfio_isolate.nodeset import CPUNodeSet, NUMANodeSet
+from vfio_isolate.nodeset import NUMANodeSet
 from vfio_isolate.serialize import *
+from vfio_isolate.workqueue import Workqueues
 
 
 def cb_numa_nodeset(ctx, param, value):
@@ -17,7 +22,7 @@ def cb_numa_nodeset(ctx, param, value):
     if value[0] == 'N':
         s = NUMANodeSet(value[1:])
         if not s.is_valid():
-            raise click.BadParameter(f"NUMA nodeset {value} is not valid")
+            raise click.BadParameter(f"NUMA nodeset {value} is not valid: {'; '.join(s.diagnose())}")
         return s
     else:
         raise click.BadParameter('must start with N')
@@ -26,17 +31,16 @@ def cb_numa_nodeset(ctx, param, value):
 def cb_cpu_nodeset(ctx, param, value):
     if not value:
         return None
-    if value[0] == 'N':
-        return cb_numa_nodeset(ctx, param, value).get_cpu_nodeset()
-    elif value[0] == 'C':
-        if not value:
-            return None
-        s = CPUNodeSet(value[1:])
-        if not s.is_valid():
-            raise click.BadParameter(f"CPU nodeset {value} is not valid")
-        return s
-    else:
-        raise click.BadParameter('must start with C or N')
+    try:
+        return expression.evaluate(value)
+    except ValueError as e:
+        raise click.BadParameter(f"CPU nodeset {value} is not valid: {e}")
+    except Exception as e:
+        # the lark parser is only loaded for input the scanner does not understand
+        from vfio_isolate.nodeset_parser import UnexpectedInput
+        if isinstance(e, UnexpectedInput):
+            raise click.BadParameter(f"CPU nodeset {value} is not valid: {str(e).strip()}")
+        raise
 
 
 class EnumChoice(click.Choice):
@@ -94,6 +98,11 @@ def compact_memory(executor, **args):
 @click.option("--mem-migrate/--no-mem-migrate", "-mm/-nmm", help="Enable memory migration (cgroup v1 only)", default=None)
 @click.option("--sched-load-balance/--no-sched-load-balance", "-lb/-nlb", help="Enable scheduler load balancing (cgroup v1 only)",
               default=None)
+@click.option("--partition", type=click.Choice(["root", "isolated", "member"]),
+              help="Make the cpuset a partition root, with or without load balancing, or a member (cgroup v2 only)")
+@click.option("--exclusive-cpus", metavar="<cpunodeset|numanodeset>", callback=cb_cpu_nodeset,
+              help="Set the CPUs reserved for the partition (cgroup v2 only)")
+@click.option("--threaded", is_flag=True, help="Create a threaded cgroup, holding single threads (cgroup v2 only)")
 @click.pass_obj
 def cpuset_create(executor, **args):
     """create a cpuset"""
@@ -112,6 +121,10 @@ def cpuset_create(executor, **args):
 @click.option("--mem-migrate/--no-mem-migrate", "-mm/-nmm", help="Enable memory migration (cgroup v1 only)", default=None)
 @click.option("--sched-load-balance/--no-sched-load-balance", "-lb/-nlb", help="Enable scheduler load balancing (cgroup v1 only)",
               default=None)
+@click.option("--partition", type=click.Choice(["root", "isolated", "member"]),
+              help="Make the cpuset a partition root, with or without load balancing, or a member (cgroup v2 only)")
+@click.option("--exclusive-cpus", metavar="<cpunodeset|numanodeset>", callback=cb_cpu_nodeset,
+              help="Set the CPUs reserved for the partition (cgroup v2 only)")
 @click.pass_obj
 def cpuset_modfify(executor, **args):
     """modify a cpuset"""
@@ -129,22 +142,90 @@ def cpuset_delete(executor, **args):
 @cli.command('move-tasks')
 @click.argument("cpuset-from", metavar="<cpuset-from>")
 @click.argument("cpuset-to", metavar="<cpuset-to>")
+@click.option("--converge", is_flag=True,
+              help="Repeat until no movable task is left in <cpuset-from>, to catch tasks forked during the move")
+@click.option("--max-rounds", metavar="<n>", type=click.IntRange(min=1), default=10,
+              help="Maximum number of rounds with --converge (default 10)")
+@click.option("--freeze", is_flag=True, help="Freeze <cpuset-from> during the move (cgroup v2 only)")
+@click.option("--recursive", "-r", is_flag=True,
+              help="Also move the tasks of all cpusets below <cpuset-from> (except <cpuset-to>)")
 @click.pass_obj
 def move_tasks(executor, **args):
     """move tasks between cpusets"""
+    cpuset_to = CPUSet(args["cpuset_to"])
+    # a destination created by an earlier command of the chain is checked when the tasks are moved
+    if cpuset_to.exists() and not cpuset_to.accepts_processes():
+        raise click.BadParameter(f"CPUSet {cpuset_to.name()} can't hold processes, "
+                                 f"it has controllers enabled for its children", param_hint="<cpuset-to>")
     executor.add(MoveTasks, args)
 
 
+@cli.command('move-threads')
+@click.argument("cpuset-to", metavar="<cpuset-to>")
+@click.argument("tids", metavar="[<tid>...]", nargs=-1, type=int)
+@click.option("--pid", metavar="<pid>", type=int, help="Move the threads of this process")
+@click.option("--name", metavar="<regex>", help="Only move the threads of <pid> whose name matches")
+@click.pass_obj
+def move_threads(executor, **args):
+    """move single threads to a cpuset"""
+    tids = array("i", args["tids"])
+    if args["pid"] is not None:
+        try:
+            tids.extend(process_threads(args["pid"], args["name"]))
+        except OSError:
+            raise click.BadParameter(f"process {args['pid']} not found")
+        except re.error as e:
+            raise click.BadParameter(f"--name {args['name']} is not valid: {e}")
+    elif args["name"] is not None:
+        raise click.BadParameter("--name requires --pid")
+    if not tids:
+        raise click.BadParameter("give TIDs or --pid")
+    executor.add(MoveThreads, MoveThreads.Param(
+        cpuset_to=args["cpuset_to"],
+        tids=tids
+    ))
+
+
 @cli.command('irq-affinity')
 @click.argument("operation", type=EnumChoice(IRQAffinityOperation))
 @click.argument("cpus", metavar="<cpunodeset|numanodeset>", callback=cb_cpu_nodeset)
+@click.option("--pci", metavar="<address>", multiple=True, help="Only the IRQs of this PCI device, e.g. 0000:01:00.0")
+@click.option("--driver", metavar="<driver>", multiple=True, help="Only the IRQs of PCI devices using this driver")
+@click.option("--netdev", metavar="<interface>", multiple=True, help="Only the IRQs of this network interface")
+@click.option("--name", metavar="<regex>", multiple=True, help="Only the IRQs whose line in /proc/interrupts matches")
 @click.pass_obj
 def irq_affinity(executor, **args):
     """manipulate the IRQ affinity"""
-    for irq in IRQS.active():
-        executor.add(IRQAffinity, IRQAffinity.Param(
-            irq=irq,
-            operation=args["operation"],
+    if args["pci"] or args["driver"] or args["netdev"] or args["name"]:
+        try:
+            irqs = list(IRQS.select(args["pci"], args["driver"], args["netdev"], args["name"]))
+        except (ValueError, re.error) as e:
+            raise click.BadParameter(str(e))
+    else:
+        irqs = IRQS.active()
+    executor.add(IRQAffinityBatch, IRQAffinityBatch.Param(
+        irqs=array("i", [irq.number for irq in irqs]),
+        operation=args["operation"],
+        cpus=args["cpus"]
+    ))
+
+
+@cli.command('kthread-affinity')
+@click.argument("cpus", metavar="<cpunodeset|numanodeset>", callback=cb_cpu_nodeset)
+@click.pass_obj
+def kthread_affinity(executor, **args):
+    """set the CPU affinity of kthreadd and all unbound kernel threads"""
+    executor.add(KThreadAffinity, args)
+
+
+@cli.command('workqueue-affinity')
+@click.argument("cpus", metavar="<cpunodeset|numanodeset>", callback=cb_cpu_nodeset)
+@click.pass_obj
+def workqueue_affinity(executor, **args):
+    """set the cpumask of the unbound workqueues"""
+    for workqueue in Workqueues.all():
+        executor.add(WorkqueueAffinity, WorkqueueAffinity.Param(
+            workqueue=workqueue,
             cpus=args["cpus"]
         ))
 
@@ -1,17 +1,95 @@
+import errno
 import os
+import re
+import time
 from abc import abstractmethod
-
-import psutil
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 
 from vfio_isolate.nodeset import CPUNodeSet, NUMANodeSet
 from vfio_isolate.output import *
 
+# from include/linux/sched.h
+PF_KTHREAD = 0x00200000
+
+
+def read_pid_stat(pid: int):
+    # (comm, flags) from /proc/<pid>/stat, None if the process is gone
+    try:
+        with open(f"/proc/{pid}/stat", "rb") as f:
+            stat = f.read()
+    except OSError:
+        return None
+    # comm may contain spaces and parentheses, the fields after it are fixed
+    start, end = stat.index(b"("), stat.rindex(b")")
+    fields = stat[end + 2:].split()
+    return stat[start + 1:end].decode(errors="replace"), int(fields[6])
+
+
+def process_threads(pid: int, name: str = None):
+    # TIDs of all threads of a process, optionally only those whose name matches the regex name
+    pattern = re.compile(name) if name else None
+    tids = array("i")
+    for entry in sorted(os.listdir(f"/proc/{pid}/task"), key=int):
+        if pattern is not None:
+            stat = read_pid_stat(int(entry))
+            if stat is None or not pattern.search(stat[0]):
+                continue
+        tids.append(int(entry))
+    return tids
+
+
+@dataclass
+class Migration:
+    moved: int = 0
+    kernel_threads: int = 0
+    exited: int = 0
+    busy: int = 0
+    failed: int = 0
+    seconds: float = 0.0
+    rounds: int = 0
+    # whether the source was found to contain only unmovable tasks in the end, None if it was not
+    # re-read after moving (single pass)
+    converged: bool = None
+    # pids that failed to move for a reason other than exiting, they are not retried
+    unmovable: set = field(default_factory=set)
+
+    @property
+    def skipped(self):
+        # tasks that can not or need not be moved
+        return self.kernel_threads + self.exited
+
+    def record_failure(self, pid: int, error: OSError):
+        # classifies a failed write to the procs file, returns a description for debug output
+        stat = None if error.errno == errno.ESRCH else read_pid_stat(pid)
+        if stat is None:
+            self.exited += 1
+            return f"PID {pid} (not running)"
+        name, flags = stat
+        self.unmovable.add(pid)
+        if flags & PF_KTHREAD:
+            self.kernel_threads += 1
+            return f"PID {pid} ({name}, kernel thread)"
+        if error.errno == errno.EBUSY:
+            self.busy += 1
+            return f"PID {pid} ({name}, busy)"
+        self.failed += 1
+        return f"PID {pid} ({name}, {error.strerror})"
+
+    def _convergence(self):
+        if self.converged is None:
+            return " (single pass)"
+        return "" if self.converged else " (not converged)"
+
+    def __str__(self):
+        return f"moved {self.moved}, skipped {self.skipped} ({self.kernel_threads} kernel threads, " \
+               f"{self.exited} exited), failed {self.busy + self.failed} ({self.busy} busy) " \
+               f"in {self.rounds} round(s){self._convergence()}, " \
+               f"{self.seconds * 1000:.1f} ms"
 
-class CPUSet:
 
-    # these are assigned below
-    mountpoint = None
-    impl = None
+class CPUSet:
 
     def __init__(self, name=None):
         if not name:
@@ -26,8 +104,16 @@ class CPUSet:
     def __repr__(self):
         return f"{self.__class__} {self.name()}"
 
+    @property
+    def mountpoint(self):
+        return hierarchy()[0]
+
+    @property
+    def impl(self):
+        return hierarchy()[1]
+
     def __path(self, path: str = None):
-        elements = [CPUSet.mountpoint]
+        elements = [self.mountpoint]
         elements.extend(self.path)
         if path:
             elements.append(path)
@@ -45,9 +131,26 @@ class CPUSet:
         else:
             return CPUSet(self.path[:-1])
 
-    def create(self, cpus: CPUNodeSet = None, mems: NUMANodeSet = None):
+    @classmethod
+    def of_task(cls, tid: int):
+        # the cpuset a thread is in, None if it is gone
+        try:
+            with open(f"/proc/{tid}/cgroup", "r") as f:
+                lines = f.read().splitlines()
+        except OSError:
+            return None
+        impl = hierarchy()[1]
+        for line in lines:
+            _, controllers, path = line.split(":", 2)
+            if impl.owns_hierarchy(controllers.split(",")):
+                return cls(path)
+        return None
+
+    def create(self, cpus: CPUNodeSet = None, mems: NUMANodeSet = None, threaded=False):
         os.mkdir(self.__path())
         self.impl.on_create(self)
+        if threaded:
+            self.set_threaded()
         if cpus:
             self.set_cpus(cpus)
         else:
@@ -59,11 +162,61 @@ class CPUSet:
 
     def remove(self):
         os.rmdir(self.__path())
+        self.impl.on_remove(self)
 
     def parents(self):
+        # all ancestors, starting at the root
         n = 0
         while n < len(self.path):
             yield CPUSet(self.path[0:n])
+            n += 1
+
+    def is_below(self, other):
+        # true for the cpuset itself, too
+        return self.path[:len(other.path)] == other.path
+
+    def subtree(self, exclude=None):
+        # this cpuset and all its descendants, parents first, without the subtree of exclude
+        stack = [self]
+        while stack:
+            cpuset = stack.pop()
+            if exclude is not None and cpuset.is_below(exclude):
+                continue
+            try:
+                with os.scandir(cpuset.__path()) as it:
+                    children = [CPUSet(cpuset.path + [e.name]) for e in it if e.is_dir(follow_symlinks=False)]
+            except FileNotFoundError:
+                if cpuset is self:
+                    raise
+                # transient cgroups (e.g. systemd scopes) come and go all the time
+                print_debug(f"CPUSet {cpuset.name()} vanished")
+                continue
+            yield cpuset
+            stack.extend(reversed(children))
+
+    def exists(self):
+        return os.path.isdir(self.__path())
+
+    def nearest_existing(self):
+        # this cpuset, or its closest ancestor if it is gone
+        cpuset = self
+        while cpuset.path and not cpuset.exists():
+            cpuset = cpuset.parent()
+        return cpuset
+
+    def contains_self(self):
+        # whether the running process is in this cpuset or below it
+        own = CPUSet.of_task(os.getpid())
+        return own is not None and own.is_below(self)
+
+    def accepts_processes(self):
+        return self.impl.accepts_processes(self)
+
+    def is_threaded(self):
+        return self.impl.is_threaded(self)
+
+    def set_threaded(self):
+        self.impl.set_threaded(self)
 
     def get_cpus(self) -> CPUNodeSet:
         return self.impl.get_cpus(self)
@@ -101,35 +254,126 @@ class CPUSet:
     def set_sched_load_balance(self, value):
         self.impl.set_sched_load_balance(self, value)
 
+    def get_partition(self):
+        # the partition type, without the state of its validity
+        state = self.impl.get_partition(self)
+        return state.split()[0] if state else state
+
+    def set_partition(self, value):
+        self.impl.set_partition(self, value)
+
+    def get_exclusive_cpus(self) -> CPUNodeSet:
+        return self.impl.get_exclusive_cpus(self)
+
+    def set_exclusive_cpus(self, mask: CPUNodeSet):
+        self.impl.set_exclusive_cpus(self, mask)
+
     def pids(self):
         return self.impl.pids(self)
 
-    def add_pid(self, pid: int, silent=False):
+    def tids(self):
+        return self.impl.tids(self)
+
+    def add_pids(self, pids, migration: Migration = None) -> Migration:
+        # moves all pids, writing them to a single open procs file
+        return self.__add_ids(self.impl.procs_file, pids, migration)
+
+    def add_tids(self, tids, migration: Migration = None) -> Migration:
+        # moves single threads, leaving the other threads of their process where they are
+        return self.__add_ids(self.impl.threads_file, tids, migration)
+
+    def __add_ids(self, file, pids, migration: Migration = None) -> Migration:
+        if migration is None:
+            migration = Migration()
+        start = time.monotonic()
+        fd = os.open(self.__path(file), os.O_WRONLY)
         try:
-            if not silent:
-                print_verbose(f"moving PID {pid} to CPUSet {self.name()}")
-            self.impl.add_pid(self, pid)
-            return True
-        except OSError:
+            for pid in pids:
+                try:
+                    os.write(fd, b"%d" % pid)
+                    migration.moved += 1
+                except OSError as e:
+                    description = migration.record_failure(pid, e)
+                    print_debug(f"unable to move {description} to CPUSet {self.name()}")
+        finally:
+            os.close(fd)
+        migration.seconds += time.monotonic() - start
+        return migration
+
+    def set_frozen(self, frozen: bool):
+        return self.impl.set_frozen(self, frozen)
+
+    def add_all_from_cpuset(self, other, max_rounds=1, freeze=False) -> Migration:
+        # Tasks forking while they are moved can leave children behind in the source. With max_rounds > 1,
+        # the source is re-read and drained again until only unmovable tasks are left in it. With freeze,
+        # the source is frozen during the move, so nothing can fork (cgroup v2 only).
+        print_verbose(f"moving all processes from CPUSet {other.name()} to CPUSet {self.name()}")
+        migration = Migration()
+        start = time.monotonic()
+        if freeze and other.contains_self():
+            # a frozen vfio-isolate could never thaw the cgroup again
+            print_error(f"warning: not freezing CPUSet {other.name()}, it contains vfio-isolate itself")
+            freeze = False
+        frozen = freeze and other.set_frozen(True)
+        try:
+            while True:
+                pids = [pid for pid in other.pids() if pid not in migration.unmovable]
+                if not pids:
+                    migration.converged = True
+                    break
+                if migration.rounds == max_rounds:
+                    migration.converged = False
+                    break
+                migration.rounds += 1
+                self.add_pids(pids, migration)
+                if max_rounds == 1:
+                    # single pass, as before: don't re-read the source
+                    break
+        finally:
+            if frozen:
+                other.set_frozen(False)
+        migration.seconds = time.monotonic() - start
+        print_verbose(f"CPUSet {other.name()} -> {self.name()}: {migration}")
+        return migration
+
+    def add_all_from_subtree(self, other, max_rounds=1, freeze=False, workers=8):
+        # drains other and every cpuset below it, except this cpuset's own subtree, on a thread pool
+        if not self.accepts_processes():
+            raise RuntimeError(f"CPUSet {self.name()} can't hold processes, "
+                               f"it has controllers enabled for its children")
+        sources = list(other.subtree(exclude=self))
+
+        def drain(source):
             try:
-                name = psutil.Process(pid).name()
-            except psutil.NoSuchProcess:
-                name = "not running"
-            print_debug(f"unable to move PID {pid} ({name}) to CPUSet {self.name()}")
-            return False
+                return self.add_all_from_cpuset(source, max_rounds, freeze)
+            except FileNotFoundError:
+                if source.exists() or not self.exists():
+                    raise
+                print_debug(f"CPUSet {source.name()} vanished")
+                return Migration()
 
-    def add_all_from_cpuset(self, other):
-        print_verbose(f"moving all processes from CPUSet {other.name()} to CPUSet {self.name()}")
-        for pid in other.pids():
-            self.add_pid(pid, True)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            return list(pool.map(drain, sources))
 
 
 class CGroupV1:
 
+    procs_file = "tasks"
+    # tasks holds TIDs, writing one moves just that thread
+    threads_file = "tasks"
+
+    @staticmethod
+    def owns_hierarchy(controllers):
+        return "cpuset" in controllers
+
     @staticmethod
     def on_create(cpuset: CPUSet):
         pass
 
+    @staticmethod
+    def on_remove(cpuset: CPUSet):
+        pass
+
     @staticmethod
     def get_cpus(cpuset: CPUSet) -> CPUNodeSet:
         with cpuset.open("cpuset.cpus", "r") as f:
@@ -190,42 +434,106 @@ class CGroupV1:
         with cpuset.open("cpuset.sched_load_balance", "w") as f:
             f.write("1" if value else "0")
 
+    @staticmethod
+    def get_partition(cpuset: CPUSet):
+        return None
+
+    @staticmethod
+    def set_partition(cpuset: CPUSet, value):
+        print_error(f"warning: CPUSet {cpuset.name()}: partitions need cgroup v2, "
+                    f"use --cpu-exclusive and --no-sched-load-balance instead")
+
+    @staticmethod
+    def get_exclusive_cpus(cpuset: CPUSet):
+        return None
+
+    @staticmethod
+    def set_exclusive_cpus(cpuset: CPUSet, mask: CPUNodeSet):
+        print_error(f"warning: CPUSet {cpuset.name()}: exclusive CPUs need cgroup v2, use --cpu-exclusive instead")
+
     @staticmethod
     def pids(cpuset: CPUSet):
-        with cpuset.open("tasks", "r") as f:
-            for pid in f:
-                yield int(pid.strip())
+        # a snapshot, the file is closed before any task is moved
+        with cpuset.open(CGroupV1.procs_file, "r") as f:
+            return array("i", map(int, f.read().split()))
+
+    @staticmethod
+    def tids(cpuset: CPUSet):
+        return CGroupV1.pids(cpuset)
+
+    @staticmethod
+    def set_frozen(cpuset: CPUSet, frozen: bool):
+        # the v1 freezer is a hierarchy of its own
+        return False
 
     @staticmethod
-    def add_pid(cpuset: CPUSet, pid: int):
-        with cpuset.open("tasks", "w") as f:
-            f.write(str(pid))
+    def accepts_processes(cpuset: CPUSet):
+        return True
+
+    @staticmethod
+    def is_threaded(cpuset: CPUSet):
+        return False
+
+    @staticmethod
+    def set_threaded(cpuset: CPUSet):
+        # every v1 cpuset takes single threads
+        pass
 
 
 class CGroupV2:
 
+    procs_file = "cgroup.procs"
+    threads_file = "cgroup.threads"
+
+    @staticmethod
+    def owns_hierarchy(controllers):
+        # the unified hierarchy is listed as "0::<path>"
+        return controllers == [""]
+
+    # cgroup path -> controllers enabled in its cgroup.subtree_control, as far as known in this run
+    subtree_control = {}
+
     @staticmethod
     def on_create(cpuset: CPUSet):
         pass
 
     @staticmethod
-    def is_controller_enabled(cpuset: CPUSet, controller):
-        with cpuset.open("cgroup.controllers", "r") as f:
-            for c in f:
-                if controller == c:
-                    return True
-        return False
+    def on_remove(cpuset: CPUSet):
+        prefix = tuple(cpuset.path)
+        for path in [p for p in CGroupV2.subtree_control if p[:len(prefix)] == prefix]:
+            del CGroupV2.subtree_control[path]
+
+    @staticmethod
+    def read_controllers(cpuset: CPUSet, file):
+        with cpuset.open(file, "r") as f:
+            return set(f.read().split())
+
+    @staticmethod
+    def enabled_subtree_controllers(cpuset: CPUSet):
+        key = tuple(cpuset.path)
+        enabled = CGroupV2.subtree_control.get(key)
+        if enabled is None:
+            enabled = CGroupV2.read_controllers(cpuset, "cgroup.subtree_control")
+            CGroupV2.subtree_control[key] = enabled
+        return enabled
 
     @staticmethod
     def enable_controller(cpuset: CPUSet, controller, enable=True):
         prefix = "+" if enable else "-"
         with cpuset.open("cgroup.subtree_control", "w") as f:
             f.write(f"{prefix}{controller}")
+        enabled = CGroupV2.enabled_subtree_controllers(cpuset)
+        if enable:
+            enabled.add(controller)
+        else:
+            enabled.discard(controller)
 
     @staticmethod
     def ensure_cpuset_controller_enabled(cpuset: CPUSet):
-        if not CGroupV2.is_controller_enabled(cpuset, "cpuset"):
-            CGroupV2.enable_controller(cpuset, "cpuset")
+        # a cgroup only has the cpuset interface files if all its ancestors delegate the controller
+        for parent in cpuset.parents():
+            if "cpuset" not in CGroupV2.enabled_subtree_controllers(parent):
+                CGroupV2.enable_controller(parent, "cpuset")
 
     @staticmethod
     def get_cpus(cpuset: CPUSet) -> CPUNodeSet:
@@ -283,30 +591,156 @@ class CGroupV2:
     def set_sched_load_balance(cpuset: CPUSet, value):
         pass
 
+    @staticmethod
+    def get_partition(cpuset: CPUSet):
+        # "member", "root" or "isolated", followed by " invalid (<reason>)" if the kernel could not
+        # set up the partition, None for the root cgroup and kernels before 5.11
+        if not cpuset.path:
+            return None
+        CGroupV2.ensure_cpuset_controller_enabled(cpuset)
+        try:
+            with cpuset.open("cpuset.cpus.partition", "r") as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def set_partition(cpuset: CPUSet, value):
+        CGroupV2.ensure_cpuset_controller_enabled(cpuset)
+        try:
+            with cpuset.open("cpuset.cpus.partition", "w") as f:
+                f.write(value)
+        except FileNotFoundError:
+            print_error(f"warning: CPUSet {cpuset.name()}: partitions need Linux 5.11 or later")
+            return
+        except OSError as e:
+            # e.g. "isolated" before Linux 5.15
+            print_error(f"warning: CPUSet {cpuset.name()}: unable to set partition {value}: {e.strerror}")
+            return
+        # the write succeeds for partitions the kernel can't set up, they are reported as invalid
+        state = CGroupV2.get_partition(cpuset)
+        if state != value:
+            print_error(f"warning: CPUSet {cpuset.name()}: partition is {state}")
+
+    @staticmethod
+    def get_exclusive_cpus(cpuset: CPUSet):
+        # None for the root cgroup and kernels before 6.7
+        if not cpuset.path:
+            return None
+        CGroupV2.ensure_cpuset_controller_enabled(cpuset)
+        try:
+            with cpuset.open("cpuset.cpus.exclusive", "r") as f:
+                return CPUNodeSet(f.read())
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def set_exclusive_cpus(cpuset: CPUSet, mask: CPUNodeSet):
+        CGroupV2.ensure_cpuset_controller_enabled(cpuset)
+        try:
+            with cpuset.open("cpuset.cpus.exclusive", "w") as f:
+                # an empty write never reaches the kernel, an empty line clears the mask
+                f.write(mask.to_list_form() or "\n")
+        except FileNotFoundError:
+            print_error(f"warning: CPUSet {cpuset.name()}: exclusive CPUs need Linux 6.7 or later")
+        except OSError as e:
+            # e.g. CPUs already exclusive to a sibling
+            print_error(f"warning: CPUSet {cpuset.name()}: unable to set exclusive CPUs "
+                        f"{mask.to_list_form()}: {e.strerror}")
+
     @staticmethod
     def pids(cpuset: CPUSet):
-        with cpuset.open("cgroup.procs", "r") as f:
-            for pid in f:
-                yield int(pid.strip())
+        # a snapshot, the file is closed before any task is moved
+        with cpuset.open(CGroupV2.procs_file, "r") as f:
+            return array("i", map(int, f.read().split()))
 
     @staticmethod
-    def add_pid(cpuset: CPUSet, pid: int):
-        with cpuset.open("cgroup.procs", "w") as f:
-            f.write(str(pid))
+    def tids(cpuset: CPUSet):
+        with cpuset.open(CGroupV2.threads_file, "r") as f:
+            return array("i", map(int, f.read().split()))
 
+    @staticmethod
+    def accepts_processes(cpuset: CPUSet):
+        # no internal process rule: only the root, threaded domains and cgroups not distributing resources
+        # to children can contain processes, threaded cgroups only take single threads
+        cgroup_type = CGroupV2.get_type(cpuset)
+        if cgroup_type == "threaded":
+            return False
+        if cgroup_type == "domain threaded":
+            return True
+        return not cpuset.path or not CGroupV2.enabled_subtree_controllers(cpuset)
 
-# SETUP
-def setup():
-    for part in psutil.disk_partitions(True):
-        fstype = part.fstype
-        if fstype.startswith("cgroup"):
-            CPUSet.mountpoint = part.mountpoint
-            if fstype.endswith("2"):
-                CPUSet.impl = CGroupV2
-            else:
-                CPUSet.impl = CGroupV1
-            return
-    raise RuntimeError("cgroups not found")
+    @staticmethod
+    def get_type(cpuset: CPUSet):
+        if not cpuset.path:
+            return "domain"
+        with cpuset.open("cgroup.type", "r") as f:
+            return f.read().strip()
+
+    @staticmethod
+    def is_threaded(cpuset: CPUSet):
+        return CGroupV2.get_type(cpuset) == "threaded"
 
+    @staticmethod
+    def set_threaded(cpuset: CPUSet):
+        # the parent becomes a threaded domain, the root of a subtree in which threads of the same
+        # process can be spread over different cgroups
+        with cpuset.open("cgroup.type", "w") as f:
+            f.write("threaded")
 
-setup()
+    @staticmethod
+    def set_frozen(cpuset: CPUSet, frozen: bool, timeout=1.0):
+        # tasks moved out of a frozen cgroup are thawed by the kernel
+        try:
+            with cpuset.open("cgroup.freeze", "w") as f:
+                f.write("1" if frozen else "0")
+        except OSError as e:
+            # the root cgroup can't be frozen, and kernels before 5.2 have no freezer in v2
+            print_debug(f"unable to {'freeze' if frozen else 'thaw'} CPUSet {cpuset.name()}: {e}")
+            return False
+        deadline = time.monotonic() + timeout
+        while frozen and time.monotonic() < deadline:
+            with cpuset.open("cgroup.events", "r") as f:
+                if "frozen 1" in f.read().splitlines():
+                    break
+            time.sleep(0.001)
+        return True
+
+
+# SETUP
+_hierarchy = None
+
+
+def _unescape(path):
+    # mountinfo escapes space, tab, newline and backslash as octal
+    return re.sub(r"\\([0-7]{3})", lambda m: chr(int(m.group(1), 8)), path)
+
+
+def setup(mountinfo="/proc/self/mountinfo"):
+    # Finds the hierarchy the cpuset controller lives in: a cgroup v1 mount with the cpuset option on
+    # legacy and hybrid systems, the cgroup2 mount otherwise.
+    global _hierarchy
+    unified = None
+    with open(mountinfo, "r") as f:
+        for line in f:
+            fields = line.split()
+            # optional fields of variable count end with a single "-"
+            separator = fields.index("-", 6)
+            fstype = fields[separator + 1]
+            if fstype == "cgroup":
+                if "cpuset" in fields[separator + 3].split(","):
+                    _hierarchy = (_unescape(fields[4]), CGroupV1)
+                    return _hierarchy
+            elif fstype == "cgroup2" and unified is None:
+                unified = _unescape(fields[4])
+    if unified is None:
+        raise RuntimeError("cgroups not found")
+    _hierarchy = (unified, CGroupV2)
+    return _hierarchy
+
+
+def hierarchy():
+    # (mountpoint, implementation) of the cpuset hierarchy, discovered on first use
+    if _hierarchy is None:
+        return setup()
+    return _hierarchy
@@ -0,0 +1,140 @@
+import re
+from functools import lru_cache
+
+from vfio_isolate.nodeset import NodeSet, CPUNodeSet, NUMANodeSet
+from vfio_isolate.output import print_error
+from vfio_isolate.topology import Topology
+
+# CPU nodeset expressions combine operands with set arithmetic, e.g. "N1-C8,24", "~C8-15" or "N0|L3:2".
+#
+# operands:   C<list>, N<list> and the topology selectors CORE:<list>, L2:<list>, L3:<list>, DIE:<list>,
+#             PKG:<list>
+# operators:  ~a (all present CPUs but a), a&b (intersection), a|b (union), a-b (difference),
+#             a^b (symmetric difference) and parentheses.
+#
+# ~ binds tightest, then &, then |, - and ^, which are evaluated left to right.
+
+_list = r"[0-9a-f]{8}(?:,[0-9a-f]{8})*(?![0-9a-f])|[0-9]+(?:-[0-9]+)?(?:,[0-9]+(?:-[0-9]+)?)*"
+_prefixes = "|".join(re.escape(f"{s}:") for s in Topology.selectors)
+_token = re.compile(rf"\s*(?:(?P<operand>(?P<prefix>{_prefixes}|C|N)(?P<list>{_list}))|(?P<operator>[~&|^()-]))")
+
+
+class ExpressionError(ValueError):
+    pass
+
+
+def _check(s, text, problems):
+    if not s.is_valid():
+        raise ExpressionError(f"{text}: {'; '.join(problems)}")
+    for problem in problems:
+        print_error(f"warning: {text}: {problem}")
+
+
+def _resolve_operand(prefix, nodes):
+    if prefix == "C":
+        s = CPUNodeSet(nodes)
+        _check(s, f"C{nodes}", s.diagnose())
+        return s.bits
+    elif prefix == "N":
+        s = NUMANodeSet(nodes)
+        if s.is_valid() and not s.get_cpu_nodeset():
+            raise ExpressionError(f"N{nodes}: NUMA nodes {s.to_list_form()} are memory only and have no CPUs")
+        _check(s, f"N{nodes}", s.diagnose(need_cpus=True))
+        return s.get_cpu_nodeset().bits
+    else:
+        return Topology.get().select(prefix[:-1], NodeSet(nodes)).bits
+
+
+class _Compiler:
+    # recursive descent over the token list, producing nested closures that compute the bitmap
+
+    def __init__(self, text):
+        self.text = text
+        self.tokens = list(self._tokenize(text))
+        self.position = 0
+
+    def _tokenize(self, text):
+        position = 0
+        text = text.rstrip()
+        while position < len(text):
+            m = _token.match(text, position)
+            if m is None:
+                raise ExpressionError(f"unexpected '{text[position:].strip()}'")
+            position = m.end()
+            if m.group("operand"):
+                yield "operand", (m.group("prefix"), m.group("list"))
+            else:
+                yield "operator", m.group("operator")
+
+    def _peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return None, None
+
+    def _next(self):
+        token = self._peek()
+        self.position += 1
+        return token
+
+    def compile(self):
+        if not self.tokens:
+            raise ExpressionError("empty expression")
+        evaluate = self._sum()
+        if self.position != len(self.tokens):
+            raise ExpressionError(f"unexpected '{self._peek()[1]}'")
+        return evaluate
+
+    def _sum(self):
+        evaluate = self._product()
+        while self._peek() in (("operator", "|"), ("operator", "-"), ("operator", "^")):
+            operator = self._next()[1]
+            left, right = evaluate, self._product()
+            if operator == "|":
+                evaluate = lambda l=left, r=right: l() | r()
+            elif operator == "-":
+                evaluate = lambda l=left, r=right: l() & ~r()
+            else:
+                evaluate = lambda l=left, r=right: l() ^ r()
+        return evaluate
+
+    def _product(self):
+        evaluate = self._unary()
+        while self._peek() == ("operator", "&"):
+            self._next()
+            left, right = evaluate, self._unary()
+            evaluate = lambda l=left, r=right: l() & r()
+        return evaluate
+
+    def _unary(self):
+        kind, value = self._next()
+        if (kind, value) == ("operator", "~"):
+            operand = self._unary()
+            return lambda o=operand: CPUNodeSet.present_cpus().bits & ~o()
+        elif (kind, value) == ("operator", "("):
+            evaluate = self._sum()
+            if self._next() != ("operator", ")"):
+                raise ExpressionError("missing ')'")
+            return evaluate
+        elif kind == "operand":
+            # operands are resolved once, at compile time
+            bits = _resolve_operand(*value)
+            return lambda: bits
+        elif kind is None:
+            raise ExpressionError("unexpected end of expression")
+        else:
+            raise ExpressionError(f"unexpected '{value}'")
+
+
+def compile_expression(text: str):
+    # returns a function computing the bitmap of the expression
+    return _Compiler(text).compile()
+
+
+@lru_cache(maxsize=None)
+def evaluate(text: str) -> CPUNodeSet:
+    # chained commands often repeat the same expression, it is only compiled and evaluated once
+    bits = compile_expression(text)()
+    if not bits:
+        # the kernel ignores or rejects empty affinities and cpusets
+        raise ExpressionError("selects no CPUs")
+    return CPUNodeSet._from_bits(bits)
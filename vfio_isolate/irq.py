@@ -1,9 +1,13 @@
 import os
+import re
+from array import array
 from typing import Generator
 
-from vfio_isolate.nodeset import CPUNodeSet, NUMANodeSet
+from vfio_isolate.nodeset import CPUNodeSet, NUMANodeSet, NodeSetParser, cache
 from vfio_isolate.output import print_debug
 
+pci_address = re.compile("(?:[0-9a-f]{4,}:)?[0-9a-f]{2}:[0-9a-f]{2}\\.[0-7]")
+
 
 class IRQ:
     base_path = "/proc/irq"
@@ -21,30 +25,223 @@ class IRQ:
         return "/".join(elements)
 
     def exists(self):
-        return os.path.exists(self.__path("smp_affinity_list"))
+        return self.number in IRQS.snapshot() or os.path.exists(self.__path("smp_affinity_list"))
 
     def get_affinity(self) -> CPUNodeSet:
+        snapshot = IRQS.snapshot()
+        if self.number in snapshot:
+            return CPUNodeSet._from_bits(snapshot.affinity[snapshot.index[self.number]])
         with open(self.__path("smp_affinity_list"), "r") as f:
             return CPUNodeSet(f.read())
 
+    def get_effective_affinity(self) -> CPUNodeSet:
+        snapshot = IRQS.snapshot()
+        if self.number in snapshot:
+            return CPUNodeSet._from_bits(snapshot.effective[snapshot.index[self.number]])
+        with open(self.__path("effective_affinity_list"), "r") as f:
+            return CPUNodeSet(f.read())
+
     def set_affinity(self, cpus: CPUNodeSet):
+        snapshot = IRQS.snapshot()
+        if self.number in snapshot and snapshot.affinity[snapshot.index[self.number]] == cpus.bits:
+            # already set, nothing to write
+            return True
         try:
             with open(self.__path("smp_affinity_list"), "w") as f:
                 f.write(cpus.to_list_form())
+            snapshot.update(self.number, cpus.bits)
             return True
         except OSError:
             print_debug(f"unable to move set affinity of IRQ {self.number} to CPUSet {cpus}")
             return False
 
     def get_node(self) -> NUMANodeSet:
-        with open(self.__path("node"), "r") as f:
-            return NUMANodeSet(f.read())
+        # empty if the IRQ is not bound to a node
+        snapshot = IRQS.snapshot()
+        if self.number in snapshot:
+            node = snapshot.node[snapshot.index[self.number]]
+        else:
+            with open(self.__path("node"), "r") as f:
+                node = int(f.read())
+        return NUMANodeSet._from_bits(1 << node if node >= 0 else 0)
+
+
+def _read(path):
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def _parse_bits(value):
+    # an empty list reads as an empty bitmap, like _read_bits in topology.py
+    value = value.decode().strip() if value else ""
+    return NodeSetParser.parse(value) if value else 0
+
+
+class IRQSnapshot:
+    # Affinity, effective affinity and NUMA node of every IRQ, each read once per run. Rows are kept
+    # in the order of the irqs array, index maps an IRQ number to its row. Affinities are bitmaps.
+
+    def __init__(self):
+        self.irqs = array("i")
+        self.affinity = []
+        self.effective = []
+        self.node = array("i")
+        self.index = {}
+
+    def __contains__(self, irq: int):
+        return irq in self.index
+
+    def __len__(self):
+        return len(self.irqs)
+
+    @classmethod
+    def read(cls, numbers=None):
+        snapshot = cls()
+        if numbers is None:
+            numbers = sorted(int(entry) for entry in os.listdir(IRQ.base_path) if entry.isnumeric())
+        for irq in numbers:
+            path = f"{IRQ.base_path}/{irq}"
+            affinity = _read(f"{path}/smp_affinity_list")
+            if affinity is None:
+                # gone, or an IRQ without affinity (e.g. 0 and 2 on x86)
+                continue
+            effective = _read(f"{path}/effective_affinity_list")
+            node = _read(f"{path}/node")
+            snapshot.index[irq] = len(snapshot.irqs)
+            snapshot.irqs.append(irq)
+            snapshot.affinity.append(_parse_bits(affinity))
+            snapshot.effective.append(_parse_bits(effective))
+            node = node.strip() if node else None
+            snapshot.node.append(int(node) if node else -1)
+        return snapshot
+
+    def update(self, irq: int, bits: int):
+        if irq in self.index:
+            self.affinity[self.index[irq]] = bits
 
 
 class IRQS:
+    interrupts_path = "/proc/interrupts"
+    pci_path = "/sys/bus/pci"
+    net_path = "/sys/class/net"
 
     @classmethod
     def active(cls) -> Generator[IRQ, None, None]:
         for file in os.listdir(IRQ.base_path):
             if file.isnumeric():
                 yield IRQ(int(file))
+
+    @staticmethod
+    @cache
+    def snapshot() -> IRQSnapshot:
+        # shared by all IRQ actions of a run, kept up to date by IRQ.set_affinity
+        return IRQSnapshot.read()
+
+    @staticmethod
+    def set_affinities(irqs, masks):
+        # sets each IRQ to the bitmap at the same position in masks, skipping those already set,
+        # returns the number of IRQs changed
+        snapshot = IRQS.snapshot()
+        changed = 0
+        for irq, bits in zip(irqs, masks):
+            if irq in snapshot and snapshot.affinity[snapshot.index[irq]] == bits:
+                continue
+            cpus = CPUNodeSet._from_bits(bits)
+            try:
+                with open(f"{IRQ.base_path}/{irq}/smp_affinity_list", "w") as f:
+                    f.write(cpus.to_list_form())
+                snapshot.update(irq, bits)
+                changed += 1
+            except OSError:
+                print_debug(f"unable to move set affinity of IRQ {irq} to CPUSet {cpus}")
+        return changed
+
+    @classmethod
+    def interrupts(cls):
+        # IRQ number -> chip, hardware IRQ, trigger type and names of the handlers, from a single parse
+        # of /proc/interrupts
+        with open(cls.interrupts_path, "r") as f:
+            cpus = len(f.readline().split())
+            result = {}
+            for line in f:
+                number, _, rest = line.partition(":")
+                if number.strip().isnumeric():
+                    result[int(number)] = " ".join(rest.split()[cpus:])
+            return result
+
+    @classmethod
+    def by_pci_device(cls, address: str, interrupts=None):
+        # MSI/MSI-X vectors of a PCI function, or its legacy interrupt line if it has none and its
+        # driver uses it
+        address = address.lower()
+        if address.count(":") == 1:
+            address = f"0000:{address}"
+        path = f"{cls.pci_path}/devices/{address}"
+        if not os.path.exists(path):
+            raise ValueError(f"PCI device {address} not found")
+        try:
+            irqs = {int(n) for n in os.listdir(f"{path}/msi_irqs")}
+        except FileNotFoundError:
+            irqs = set()
+        if not irqs:
+            with open(f"{path}/irq", "r") as f:
+                irq = int(f.read())
+            if irq and cls._uses_intx(path, address, irq, interrupts if interrupts is not None else cls.interrupts()):
+                irqs.add(irq)
+        return irqs
+
+    @staticmethod
+    def _uses_intx(path, address, irq, interrupts):
+        # INTx lines are often shared: a device only owns its line if its driver registered a handler on
+        # it. vfio-pci does so only while a VM uses INTx, until then the line belongs to other devices.
+        if not os.path.exists(f"{path}/driver"):
+            return False
+        driver = os.path.basename(os.path.realpath(f"{path}/driver"))
+        if driver == "vfio-pci":
+            return f"vfio-intx({address})" in interrupts.get(irq, "")
+        return irq in interrupts
+
+    @classmethod
+    def by_driver(cls, driver: str, interrupts=None):
+        # the IRQs of all PCI functions bound to a driver, e.g. "vfio-pci" or "nvme"
+        path = f"{cls.pci_path}/drivers/{driver}"
+        if not os.path.exists(path):
+            raise ValueError(f"PCI driver {driver} not found")
+        irqs = set()
+        for entry in os.listdir(path):
+            if pci_address.fullmatch(entry):
+                irqs |= cls.by_pci_device(entry, interrupts)
+        return irqs
+
+    @classmethod
+    def by_netdev(cls, name: str, interrupts=None):
+        # the IRQs of the PCI function behind a network interface, which may be a parent of its device
+        # (e.g. for virtio)
+        path = f"{cls.net_path}/{name}/device"
+        if not os.path.exists(path):
+            raise ValueError(f"network interface {name} has no device")
+        for element in reversed(os.path.realpath(path).split("/")):
+            if pci_address.fullmatch(element):
+                return cls.by_pci_device(element, interrupts)
+        raise ValueError(f"network interface {name} is not a PCI device")
+
+    @classmethod
+    def select(cls, pci=(), drivers=(), netdevs=(), names=()) -> Generator[IRQ, None, None]:
+        # the union of the IRQs selected by each criterion, that are active in /proc/interrupts
+        interrupts = cls.interrupts()
+        selected = set()
+        for address in pci:
+            selected |= cls.by_pci_device(address, interrupts)
+        for driver in drivers:
+            selected |= cls.by_driver(driver, interrupts)
+        for netdev in netdevs:
+            selected |= cls.by_netdev(netdev, interrupts)
+        # names are regular expressions matched against the lines in /proc/interrupts, e.g. "nvme0q"
+        for pattern in names:
+            regex = re.compile(pattern)
+            selected |= {irq for irq, description in interrupts.items() if regex.search(description)}
+        for irq in sorted(selected & interrupts.keys()):
+            yield IRQ(irq)
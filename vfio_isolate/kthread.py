@@ -0,0 +1,94 @@
+import os
+from array import array
+
+from vfio_isolate.cpuset import PF_KTHREAD, read_pid_stat
+from vfio_isolate.nodeset import CPUNodeSet, cache
+from vfio_isolate.output import print_debug
+
+# from include/linux/sched.h, set for kernel threads bound to a CPU (e.g. ksoftirqd/N, kworker/N:M)
+PF_NO_SETAFFINITY = 0x04000000
+
+KTHREADD_PID = 2
+
+
+class KThreadSnapshot:
+    # PIDs of kthreadd and all kernel threads that may run on any CPU, with their affinity bitmaps.
+    # Rows are kept in the order of the pids array, index maps a PID to its row.
+
+    def __init__(self):
+        self.pids = array("i")
+        self.affinity = []
+        self.index = {}
+
+    def __contains__(self, pid: int):
+        return pid in self.index
+
+    def __len__(self):
+        return len(self.pids)
+
+    @classmethod
+    def read(cls):
+        # a single sweep over /proc: bound kernel threads are recognized by their flags, without a syscall
+        snapshot = cls()
+        for entry in os.listdir("/proc"):
+            if not entry.isdigit():
+                continue
+            stat = read_pid_stat(int(entry))
+            if stat is None:
+                continue
+            flags = stat[1]
+            if flags & PF_KTHREAD and not flags & PF_NO_SETAFFINITY:
+                try:
+                    bits = CPUNodeSet(os.sched_getaffinity(int(entry))).bits
+                except OSError:
+                    continue
+                snapshot.index[int(entry)] = len(snapshot.pids)
+                snapshot.pids.append(int(entry))
+                snapshot.affinity.append(bits)
+        return snapshot
+
+    def update(self, pid: int, bits: int):
+        if pid in self.index:
+            self.affinity[self.index[pid]] = bits
+
+
+class KThreads:
+
+    @staticmethod
+    @cache
+    def snapshot() -> KThreadSnapshot:
+        # shared by all kernel thread actions of a run, kept up to date by set_affinities
+        return KThreadSnapshot.read()
+
+    @classmethod
+    def unbound(cls):
+        return cls.snapshot().pids
+
+    @staticmethod
+    def set_affinities(pids, masks):
+        # sets each kernel thread to the bitmap at the same position in masks, skipping those already
+        # set, returns the number of threads changed
+        snapshot = KThreads.snapshot()
+        cpu_lists = {}
+        changed = 0
+        for pid, bits in zip(pids, masks):
+            if pid in snapshot and snapshot.affinity[snapshot.index[pid]] == bits:
+                continue
+            if bits not in cpu_lists:
+                cpu_lists[bits] = list(CPUNodeSet._from_bits(bits))
+            try:
+                os.sched_setaffinity(pid, cpu_lists[bits])
+                snapshot.update(pid, bits)
+                changed += 1
+            except ProcessLookupError:
+                pass
+            except OSError as e:
+                print_debug(f"unable to set affinity of kernel thread {pid} to CPUs "
+                            f"{CPUNodeSet._from_bits(bits)}: {e.strerror}")
+        return changed
+
+
+if __name__ == "__main__":
+    snapshot = KThreads.snapshot()
+    for pid, bits in zip(snapshot.pids, snapshot.affinity):
+        print(f"{pid} {read_pid_stat(pid)[0]} {CPUNodeSet._from_bits(bits).to_list_form()}")
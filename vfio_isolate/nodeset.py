@@ -1,119 +1,343 @@
-import os
-
-from vfio_isolate.nodeset_parser import Transformer, Lark_StandAlone
+import re
+import time
+from functools import lru_cache
 
 _base_path = "/sys/devices/system"
 
+
+class _HotplugGeneration:
+    # A counter that changes whenever CPUs or NUMA nodes go on- or offline. The online files are
+    # re-read at most once per interval, so checking the generation is cheap enough to do on every
+    # access to a cached value.
+    interval = 1.0
+
+    def __init__(self):
+        self.counter = 0
+        self.state = None
+        self.checked = None
+
+    def current(self):
+        now = time.monotonic()
+        if self.checked is None or now - self.checked >= self.interval:
+            self.checked = now
+            state = tuple(self._read(f"{_base_path}/{path}") for path in ("cpu/online", "node/online"))
+            if state != self.state:
+                self.state = state
+                self.counter += 1
+        return self.counter
+
+    def reset(self):
+        self.checked = None
+
+    @staticmethod
+    def _read(path):
+        try:
+            with open(path, "r") as f:
+                return f.read()
+        except OSError:
+            return None
+
+
+_generation = _HotplugGeneration()
+_not_cached = object()
+_caches = []
+
+
 def cache(func):
+    # memoizes a function without arguments, until invalidate() is called on it or the hotplug
+    # generation changes
     def wrapper():
-        if not wrapper.value:
+        generation = _generation.current()
+        if wrapper.value is _not_cached or wrapper.generation != generation:
             wrapper.value = func()
+            wrapper.generation = generation
         return wrapper.value
 
-    wrapper.value = None
+    def invalidate():
+        wrapper.value = _not_cached
+
+    wrapper.value = _not_cached
+    wrapper.generation = None
+    wrapper.invalidate = invalidate
+    _caches.append(wrapper)
     return wrapper
 
 
-class _LarkTransformer(Transformer):
+def invalidate_caches():
+    # forgets everything cached with @cache, e.g. after changing the topology on purpose
+    for wrapper in _caches:
+        wrapper.invalidate()
+    _generation.reset()
+
+
+def _range_bits(first, last):
+    if last < first:
+        return 0
+    return ((1 << (last - first + 1)) - 1) << first
+
+
+_number = r"(?:0|[1-9][0-9]*)"
+_list_entry = rf"{_number}(?:-{_number})?"
+_list_form = re.compile(rf"{_list_entry}(?:,{_list_entry})*")
+_mask_form = re.compile(r"[0-9a-f]{8}(?:,[0-9a-f]{8})*")
+
+
+def _scan(string_representation):
+    # Fast path for the list_form and mask_form rules of nodeset.lark, which covers everything the
+    # kernel writes. Returns None for anything else, so the lark parser can handle (or reject) it.
+    if _mask_form.fullmatch(string_representation):
+        return int(string_representation.replace(",", ""), 16)
+    if not _list_form.fullmatch(string_representation):
+        return None
+    if _mask_form.match(string_representation):
+        # lark lexes a leading run of 8 digits as MASK_ENTRY, which then fails to parse
+        return None
+    bits = 0
+    for entry in string_representation.split(","):
+        first, _, last = entry.partition("-")
+        if last:
+            bits |= _range_bits(int(first), int(last))
+        else:
+            bits |= 1 << int(first)
+    return bits
+
+
+# Lark only looks up callbacks by rule name, so this does not need to derive from
+# nodeset_parser.Transformer - which keeps nodeset_parser out of the import path.
+class _LarkTransformer:
 
     def list_form(self, children):
-        value = set()
+        value = 0
         for item in children:
-            value = value.union(item)
+            value |= item
         return value
 
     def list_entry(self, children):
         v = children[0]
-        if isinstance(v, str):
-            return {int(v)}
-        elif isinstance(v, range):
-            return set(v)
+        if isinstance(v, int):
+            return v
+        elif isinstance(v, str):
+            return 1 << int(v)
         else:
             raise Exception("don't know how to handle")
 
 
     def mask_form(self, children):
-        values = []
-        for item in children:
-            values.insert(0, int(item.value, 16))
-        bit = 0
-        result = set()
-        for value in values:
-            for n in range(32):
-                if value & 1:
-                    result.add(bit)
-                value = value >> 1
-                bit = bit + 1
-        return result
+        # words are most significant first, so the concatenation is the whole bitmap in hex
+        return int("".join(item.value for item in children), 16)
 
     def range(self, children):
-        return range(int(children[0].value), int(children[1].value) + 1)
+        return _range_bits(int(children[0].value), int(children[1].value))
 
 
 class NodeSetParser:
+    # parse results are plain ints, so they can be shared between all NodeSets parsed from the same
+    # string. The kernel hands out the same few strings over and over (e.g. for every IRQ).
+    cache_size = 1024
+    _parser = None
+
+    @classmethod
+    def get_parser(cls):
+        if cls._parser is None:
+            from vfio_isolate.nodeset_parser import Lark_StandAlone
+            cls._parser = Lark_StandAlone(transformer=_LarkTransformer())
+        return cls._parser
+
+    @staticmethod
+    @lru_cache(maxsize=cache_size)
+    def _parse(string_representation):
+        bits = _scan(string_representation)
+        if bits is None:
+            bits = NodeSetParser.get_parser().parse(string_representation)
+        return bits
+
     @classmethod
     def parse(cls, string_representation):
-        parser = Lark_StandAlone(transformer=_LarkTransformer())
-        return parser.parse(string_representation)
+        return cls._parse(string_representation)
+
+    @classmethod
+    def cache_info(cls):
+        # named tuple with hits, misses, maxsize and currsize
+        return cls._parse.cache_info()
+
+    @classmethod
+    def cache_clear(cls):
+        cls._parse.cache_clear()
 
 
 class NodeSet:
+    # NodeSets are immutable values: members are stored as an integer bitmap, where bit n is set if
+    # node n is in the set. All operations return new instances.
+    __slots__ = ("bits",)
 
     def __init__(self, initial=None):
         if not initial:
-            self.nodes = set()
-        elif isinstance(initial, set):
-            self.nodes = initial
+            bits = 0
+        elif isinstance(initial, int):
+            if initial < 0:
+                raise Exception("unable to initialize NodeSet from negative bitmap")
+            bits = initial
         elif isinstance(initial, str):
+            # the kernel writes an empty line for empty sets, e.g. the cpulist of memory only nodes
             initial = initial.rstrip()
-            self.nodes = NodeSetParser.parse(initial)
+            bits = NodeSetParser.parse(initial) if initial else 0
+        elif isinstance(initial, NodeSet):
+            bits = initial.bits
+        elif isinstance(initial, (set, frozenset, list, tuple, range)):
+            bits = 0
+            for node in initial:
+                bits |= 1 << node
         else:
             raise Exception("unable to initialize NodeSet")
+        object.__setattr__(self, "bits", bits)
+
+    @classmethod
+    def _from_bits(cls, bits):
+        # skips the type dispatch in __init__, for results of operations on other NodeSets
+        nodeset = cls.__new__(cls)
+        object.__setattr__(nodeset, "bits", bits)
+        return nodeset
+
+    @staticmethod
+    def universe():
+        # bitmap of all nodes that can exist, negation is relative to it
+        return CPUNodeSet.universe()
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{self.__class__.__name__} is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"{self.__class__.__name__} is immutable")
+
+    def __reduce__(self):
+        return self.__class__, (self.bits,)
+
+    def __setstate__(self, state):
+        # undo files written by older versions pickled the members as a set
+        NodeSet.__init__(self, state.get("nodes", state.get("bits")))
+
+    @property
+    def nodes(self):
+        return set(self)
 
     def __repr__(self):
         return f"{self.__class__.__name__} {self.to_list_form()}"
 
     def __iter__(self):
-        return iter(self.nodes)
+        bits = self.bits
+        while bits:
+            low = bits & -bits
+            yield low.bit_length() - 1
+            bits ^= low
 
     def __len__(self):
-        return len(self.nodes)
+        return bin(self.bits).count("1")
 
     def __bool__(self):
-        return len(self.nodes) != 0
+        return self.bits != 0
+
+    def __contains__(self, node):
+        return node >= 0 and (self.bits >> node) & 1 == 1
 
     def __eq__(self, other):
         if isinstance(other, NodeSet):
-            return self.nodes == other.nodes
+            return self.bits == other.bits
         return False
 
+    def __hash__(self):
+        return hash(self.bits)
+
+    def __le__(self, other):
+        if not isinstance(other, NodeSet):
+            return NotImplemented
+        return self.issubset(other)
+
+    def __lt__(self, other):
+        if not isinstance(other, NodeSet):
+            return NotImplemented
+        return self.bits != other.bits and self.issubset(other)
+
+    def __ge__(self, other):
+        if not isinstance(other, NodeSet):
+            return NotImplemented
+        return other.issubset(self)
+
+    def __gt__(self, other):
+        if not isinstance(other, NodeSet):
+            return NotImplemented
+        return self.bits != other.bits and other.issubset(self)
+
+    def __or__(self, other):
+        if not isinstance(other, NodeSet):
+            return NotImplemented
+        return self.union(other)
+
+    def __and__(self, other):
+        if not isinstance(other, NodeSet):
+            return NotImplemented
+        return self.intersection(other)
+
+    def __sub__(self, other):
+        if not isinstance(other, NodeSet):
+            return NotImplemented
+        return self.difference(other)
+
+    def __xor__(self, other):
+        if not isinstance(other, NodeSet):
+            return NotImplemented
+        return self.symmetric_difference(other)
+
+    def __invert__(self):
+        return self.negation()
+
     def negation(self):
-        return self.__class__({cpu for cpu in CPUNodeSet.possible_cpus() if cpu not in self.nodes})
+        return self._from_bits(self.universe() & ~self.bits)
 
     def union(self, other):
-        return self.__class__(self.nodes.union(other.nodes))
+        return self._from_bits(self.bits | other.bits)
 
     def intersection(self, other):
-        return self.__class__(self.nodes.intersection(other.nodes))
+        return self._from_bits(self.bits & other.bits)
+
+    def difference(self, other):
+        return self._from_bits(self.bits & ~other.bits)
+
+    def symmetric_difference(self, other):
+        return self._from_bits(self.bits ^ other.bits)
+
+    def issubset(self, other):
+        return self.bits & ~other.bits == 0
+
+    def runs(self):
+        # yields (first, last) for every run of consecutive members, ascending
+        bits = self.bits
+        while bits:
+            low = bits & -bits
+            # adding the lowest set bit carries through the whole run
+            carried = bits + low
+            yield low.bit_length() - 1, (carried & -carried).bit_length() - 2
+            bits &= carried
 
     def to_list_form(self):
-        nums = sorted(self.nodes)
-        gaps = [[s, e] for s, e in zip(nums, nums[1:]) if s + 1 < e]
-        edges = iter(nums[:1] + sum(gaps, []) + nums[-1:])
         segments = []
-        for r in zip(edges, edges):
-            if r[0] == r[1]:
-                segments.append(str(r[0]))
+        for first, last in self.runs():
+            if first == last:
+                segments.append(str(first))
             else:
-                segments.append("{}-{}".format(r[0], r[1]))
+                segments.append("{}-{}".format(first, last))
         return ",".join(segments)
 
+    def to_mask_form(self, width=None):
+        # comma separated 32 bit hex words, most significant first, like the kernel's cpumask files.
+        # width is the number of bits to cover (e.g. the number of possible CPUs), it defaults to
+        # the smallest number of words holding all members.
+        words = max(-(-max(self.bits.bit_length(), width or 0) // 32), 1)
+        digits = "%0*x" % (words * 8, self.bits)
+        return ",".join([digits[i:i + 8] for i in range(0, len(digits), 8)])
 
-class CPUNodeSet(NodeSet):
 
-    @staticmethod
-    def __cpu_path(node, path=""):
-        return f"/sys/devices/system/cpu/cpu{node}{path}"
+class CPUNodeSet(NodeSet):
+    __slots__ = ()
 
     @staticmethod
     @cache
@@ -127,18 +351,45 @@ class CPUNodeSet(NodeSet):
         with open(f"{_base_path}/cpu/possible") as f:
             return CPUNodeSet(f.read())
 
+    @staticmethod
+    @cache
+    def online_cpus():
+        with open(f"{_base_path}/cpu/online") as f:
+            return CPUNodeSet(f.read())
+
+    @staticmethod
+    @cache
+    def universe():
+        return CPUNodeSet.possible_cpus().bits
+
     def is_valid(self):
-        for node in self:
-            if not os.path.exists(self.__cpu_path(node)):
-                return False
-        return True
+        # a CPU exists (has a sysfs directory) if it is present, even when it is offline
+        return self.issubset(CPUNodeSet.present_cpus())
+
+    def diagnose(self):
+        # reasons why (part of) this set can not be used, the absent CPUs make it invalid
+        problems = []
+        present = CPUNodeSet.present_cpus()
+        absent = self - present
+        if absent:
+            problems.append(f"CPUs {absent.to_list_form()} do not exist")
+        offline = (self & present) - CPUNodeSet.online_cpus()
+        if offline:
+            problems.append(f"CPUs {offline.to_list_form()} are offline")
+        return problems
+
+    def get_numa_nodeset(self):
+        # the nodes these CPUs belong to
+        cpu_to_node = NUMANodeSet.cpu_to_node()
+        bits = 0
+        for cpu in self:
+            if cpu < len(cpu_to_node) and cpu_to_node[cpu] >= 0:
+                bits |= 1 << cpu_to_node[cpu]
+        return NUMANodeSet._from_bits(bits)
 
 
 class NUMANodeSet(NodeSet):
-
-    @staticmethod
-    def __node_path(node, path=""):
-        return f"/sys/devices/system/node/node{node}{path}"
+    __slots__ = ()
 
     @staticmethod
     @cache
@@ -152,15 +403,147 @@ class NUMANodeSet(NodeSet):
         with open(f"{_base_path}/node/possible") as f:
             return NUMANodeSet(f.read())
 
+    @staticmethod
+    @cache
+    def cpu_map():
+        # node -> bitmap of its CPUs, for every online node
+        from vfio_isolate.topology import Topology
+        node_cpus = Topology.get().node_cpus
+        return {node: node_cpus[node] if node < len(node_cpus) else 0 for node in NUMANodeSet.online_nodes()}
+
+    @staticmethod
+    def cpu_to_node():
+        # cpu -> node, -1 for CPUs not belonging to any node
+        from vfio_isolate.topology import Topology
+        return Topology.get().cpu_node
+
+    @staticmethod
+    @cache
+    def cpu_nodes():
+        # nodes that have CPUs, the others are memory only (e.g. CXL or HBM memory)
+        return NUMANodeSet([node for node, bits in NUMANodeSet.cpu_map().items() if bits])
+
+    def memory_only(self):
+        return self.intersection(NUMANodeSet.online_nodes()) - NUMANodeSet.cpu_nodes()
+
+    @staticmethod
+    @cache
+    def universe():
+        return NUMANodeSet.possible_nodes().bits
+
     def is_valid(self):
-        for node in self:
-            if not os.path.exists(self.__node_path(node)):
-                return False
-        return True
+        return self.issubset(NUMANodeSet.online_nodes())
+
+    def diagnose(self, need_cpus=False):
+        # reasons why (part of) this set can not be used, nodes that are not online make it invalid
+        problems = []
+        missing = self - NUMANodeSet.online_nodes()
+        offline = missing & NUMANodeSet.possible_nodes()
+        if missing - offline:
+            problems.append(f"NUMA nodes {(missing - offline).to_list_form()} do not exist")
+        if offline:
+            problems.append(f"NUMA nodes {offline.to_list_form()} are offline")
+        if need_cpus:
+            memory_only = self.memory_only()
+            if memory_only:
+                problems.append(f"NUMA nodes {memory_only.to_list_form()} are memory only and have no CPUs")
+        return problems
 
     def get_cpu_nodeset(self):
-        cpus = CPUNodeSet()
+        # memory only nodes contribute no CPUs, see memory_only()
+        cpu_map = NUMANodeSet.cpu_map()
+        bits = 0
         for node in self:
-            with open(self.__node_path(node, "/cpulist")) as f:
-                cpus = cpus.union(CPUNodeSet(f.read()))
-        return cpus
+            bits |= cpu_map.get(node, 0)
+        return CPUNodeSet._from_bits(bits)
+
+
+if __name__ == "__main__":
+    import random
+    import sys
+    import timeit
+    from vfio_isolate.nodeset_parser import Lark_StandAlone
+
+    def scanner_corpus(count=20000, seed=0):
+        # deterministic differential corpus for _scan: edge cases, kernel style lists and masks, and
+        # random strings over the grammar's alphabet. Numbers stay short, so that no entry expands to a
+        # huge bitmap.
+        yield from ["", "0", "01", "00", "5-3", "3-3", "0-0", "1-", "-1", ",", "1,", ",1", "1,,2", "1--2",
+                    "12345678", "0000000f", "ffffffff,00000000", "12345678,1", "1,12345678", "1234567",
+                    "123456789", "0000000g", "FFFFFFFF", "0-6,16-22", "0-383", " 1", "1 "]
+        rng = random.Random(seed)
+        alphabet = "0123456789abcdef,-"
+        for n in range(count):
+            kind = n % 4
+            if kind == 0:
+                entries = []
+                for _ in range(rng.randint(1, 4)):
+                    first = rng.randint(0, 999)
+                    entries.append(f"{first}-{rng.randint(0, 999)}" if rng.random() < 0.5 else str(first))
+                yield ",".join(entries)
+            elif kind == 1:
+                yield ",".join("%08x" % rng.getrandbits(32) for _ in range(rng.randint(1, 4)))
+            else:
+                # short digit runs only: "1,12345678" style inputs are covered by the fixed cases above
+                text = "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 10)))
+                if not re.search(r"[0-9a-f]{5}", text):
+                    yield text
+
+    def check_scanner(corpus=None):
+        # compares _scan against the lark parser, returns the mismatching inputs. _scan may decline
+        # (return None) anything, but whatever it returns must be what lark returns.
+        parser = Lark_StandAlone(transformer=_LarkTransformer())
+        mismatches = []
+        for text in corpus if corpus is not None else scanner_corpus():
+            bits = _scan(text)
+            if bits is None:
+                continue
+            try:
+                expected = parser.parse(text)
+            except Exception:
+                expected = None
+            if bits != expected:
+                mismatches.append(text)
+        return mismatches
+
+    mismatches = check_scanner()
+    if mismatches:
+        print(f"scanner differs from the lark parser for {mismatches[:10]}")
+        sys.exit(1)
+    print("scanner matches the lark parser on the differential corpus")
+
+    samples = ["0-6,16-22", "0-383", "3", "00000000,ffffffff,0000ff00"]
+    full_mask = NodeSet(range(8192)).to_mask_form()
+    sparse = NodeSet(range(0, 8192, 3))
+
+    def fresh_parser():
+        for sample in samples:
+            Lark_StandAlone(transformer=_LarkTransformer()).parse(sample)
+
+    def shared_parser():
+        for sample in samples:
+            NodeSetParser.get_parser().parse(sample)
+
+    def scanner():
+        for sample in samples:
+            _scan(sample)
+
+    def interned():
+        for sample in samples:
+            NodeSetParser.parse(sample)
+
+    def parse_mask():
+        NodeSetParser.get_parser().parse(full_mask)
+
+    def emit_mask():
+        sparse.to_mask_form()
+
+    for name, func, number, unit in [("fresh parser per parse", fresh_parser, 500, "parses"),
+                                     ("shared parser", shared_parser, 20000, "parses"),
+                                     ("scanner", scanner, 200000, "parses"),
+                                     ("interned", interned, 500000, "parses"),
+                                     ("8192 cpu mask_form parse", parse_mask, 2000, "masks"),
+                                     ("8192 cpu to_mask_form", emit_mask, 200000, "masks")]:
+        seconds = min(timeit.repeat(func, number=number, repeat=3))
+        per_call = len(samples) if unit == "parses" else 1
+        print(f"{name:>24}: {number * per_call / seconds:12.0f} {unit}/s")
@@ -0,0 +1,256 @@
+import os
+import pickle
+import re
+from array import array
+
+from vfio_isolate.nodeset import NodeSetParser, NodeSet, CPUNodeSet, NUMANodeSet, cache
+from vfio_isolate.output import print_debug
+
+
+def _read(path):
+    try:
+        with open(path, "r") as f:
+            return f.read().rstrip()
+    except OSError:
+        return None
+
+
+def _read_bits(path):
+    value = _read(path)
+    return NodeSetParser.parse(value) if value else 0
+
+
+def _lowest_bit(bits):
+    return (bits & -bits).bit_length()
+
+
+class Topology:
+    # Index of the CPU and NUMA topology, built from a single sweep over sysfs.
+    #
+    # For every CPU, the cpu_* arrays hold the index of the core, die, package, L2 and L3 domain and
+    # NUMA node it belongs to, or -1 if it is unknown (e.g. for offline CPUs). Cores, dies and cache
+    # domains are numbered in the order of their lowest CPU, packages and nodes use the kernel's
+    # numbering. The *_cpus lists map a domain index back to the bitmap of its CPUs.
+    base_path = "/sys/devices/system"
+    boot_id_path = "/proc/sys/kernel/random/boot_id"
+    cache_path = "/run/vfio-isolate/topology"
+    # part of the cache key, bump whenever the attributes of Topology change
+    format_version = 2
+
+    # CPU selector prefix -> domain table it indexes
+    selectors = {
+        "CORE": "core_cpus",
+        "L2": "l2_cpus",
+        "L3": "l3_cpus",
+        "DIE": "die_cpus",
+        "PKG": "package_cpus",
+    }
+
+    cpudir = re.compile("cpu(\\d+)")
+    nodedir = re.compile("node(\\d+)")
+    cachedir = re.compile("index(\\d+)")
+
+    def __init__(self, key=None):
+        self.key = key
+        self.cpu_core = array("i")
+        self.cpu_die = array("i")
+        self.cpu_package = array("i")
+        self.cpu_l2 = array("i")
+        self.cpu_l3 = array("i")
+        self.cpu_node = array("i")
+        self.core_cpus = []
+        self.die_cpus = []
+        self.package_cpus = []
+        self.l2_cpus = []
+        self.l3_cpus = []
+        self.node_cpus = []
+        # node -> distances to the online nodes, in ascending node order
+        self.node_distances = {}
+        self.cpus_online = 0
+        self.cpus_present = 0
+        self.cpus_possible = 0
+        self.nodes_online = 0
+        self.nodes_possible = 0
+
+    def __repr__(self):
+        return f"Topology ({len(self.core_cpus)} cores, {len(self.l3_cpus)} L3 domains, " \
+               f"{len(self.node_cpus)} nodes)"
+
+    def cpu_count(self):
+        return len(self.cpu_core)
+
+    def distance(self, node_from: int, node_to: int):
+        online = list(NUMANodeSet._from_bits(self.nodes_online))
+        return self.node_distances[node_from][online.index(node_to)]
+
+    @classmethod
+    def current_key(cls):
+        # changes with every reboot, every CPU or node hotplug event and every change of the format
+        return (cls.format_version,
+                _read(cls.boot_id_path),
+                _read(f"{cls.base_path}/cpu/online"),
+                _read(f"{cls.base_path}/cpu/present"),
+                _read(f"{cls.base_path}/node/online"))
+
+    @classmethod
+    def scan(cls, key=None):
+        topology = cls(key if key is not None else cls.current_key())
+        topology._scan_cpus()
+        topology._scan_nodes()
+        return topology
+
+    def _scan_cpus(self):
+        base = f"{self.base_path}/cpu"
+        self.cpus_online = _read_bits(f"{base}/online")
+        self.cpus_present = _read_bits(f"{base}/present")
+        self.cpus_possible = _read_bits(f"{base}/possible")
+
+        cores, dies, packages, l2, l3, nodes = {}, {}, {}, {}, {}, {}
+        with os.scandir(base) as it:
+            for entry in it:
+                m = Topology.cpudir.fullmatch(entry.name)
+                if m is None:
+                    continue
+                cpu = int(m.group(1))
+                topology = f"{entry.path}/topology"
+                core = _read_bits(f"{topology}/core_cpus_list") or _read_bits(f"{topology}/thread_siblings_list")
+                if core:
+                    cores[cpu] = core
+                die = _read_bits(f"{topology}/die_cpus_list") or _read_bits(f"{topology}/core_siblings_list")
+                if die:
+                    dies[cpu] = die
+                package = _read(f"{topology}/physical_package_id")
+                if package is not None and int(package) >= 0:
+                    packages[cpu] = int(package)
+                self._scan_caches(cpu, f"{entry.path}/cache", l2, l3)
+                with os.scandir(entry.path) as links:
+                    for link in links:
+                        n = Topology.nodedir.fullmatch(link.name)
+                        if n is not None:
+                            nodes[cpu] = int(n.group(1))
+
+        count = self.cpus_possible.bit_length()
+        for cpu in set(cores) | set(dies) | set(packages) | set(nodes):
+            count = max(count, cpu + 1)
+        self.cpu_core, self.core_cpus = self._index_domains(cores, count)
+        self.cpu_die, self.die_cpus = self._index_domains(dies, count)
+        self.cpu_l2, self.l2_cpus = self._index_domains(l2, count)
+        self.cpu_l3, self.l3_cpus = self._index_domains(l3, count)
+        self.cpu_package, self.package_cpus = self._number_domains(packages, count)
+        self.cpu_node, self.node_cpus = self._number_domains(nodes, count)
+
+    @staticmethod
+    def _scan_caches(cpu, path, l2, l3):
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    if Topology.cachedir.fullmatch(entry.name) is None:
+                        continue
+                    level = _read(f"{entry.path}/level")
+                    if level == "2":
+                        l2[cpu] = _read_bits(f"{entry.path}/shared_cpu_list")
+                    elif level == "3":
+                        l3[cpu] = _read_bits(f"{entry.path}/shared_cpu_list")
+        except OSError:
+            pass
+
+    @staticmethod
+    def _index_domains(masks, count):
+        # masks: cpu -> bitmap of the CPUs in its domain, numbered by their lowest CPU
+        domains = sorted(set(masks.values()), key=_lowest_bit)
+        index = {bits: n for n, bits in enumerate(domains)}
+        cpu_domain = array("i", [-1]) * count
+        for cpu, bits in masks.items():
+            cpu_domain[cpu] = index[bits]
+        return cpu_domain, domains
+
+    @staticmethod
+    def _number_domains(ids, count):
+        # ids: cpu -> domain number as given by the kernel
+        cpu_domain = array("i", [-1]) * count
+        domains = [0] * (max(ids.values()) + 1 if ids else 0)
+        for cpu, domain in ids.items():
+            cpu_domain[cpu] = domain
+            domains[domain] |= 1 << cpu
+        return cpu_domain, domains
+
+    def _scan_nodes(self):
+        base = f"{self.base_path}/node"
+        self.nodes_online = _read_bits(f"{base}/online")
+        self.nodes_possible = _read_bits(f"{base}/possible")
+        try:
+            with os.scandir(base) as it:
+                for entry in it:
+                    m = Topology.nodedir.fullmatch(entry.name)
+                    if m is None:
+                        continue
+                    distances = _read(f"{entry.path}/distance")
+                    if distances:
+                        self.node_distances[int(m.group(1))] = array("i", map(int, distances.split()))
+        except OSError:
+            # no NUMA support in the kernel
+            pass
+        if len(self.node_cpus) < self.nodes_possible.bit_length():
+            self.node_cpus.extend([0] * (self.nodes_possible.bit_length() - len(self.node_cpus)))
+
+    @classmethod
+    def load(cls):
+        # reuses the topology written by an earlier invocation as long as the system did not reboot or
+        # see any hotplug event in between
+        key = cls.current_key()
+        try:
+            with open(cls.cache_path, "rb") as f:
+                topology = pickle.load(f)
+            if isinstance(topology, cls) and topology.key == key:
+                return topology
+        except (OSError, pickle.PickleError, EOFError, AttributeError, ImportError, TypeError, ValueError):
+            # unreadable, or written by an incompatible version
+            pass
+        topology = cls.scan(key)
+        topology.save()
+        return topology
+
+    def save(self):
+        try:
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+            temp_path = f"{self.cache_path}.{os.getpid()}"
+            with open(temp_path, "wb") as f:
+                pickle.dump(self, f)
+            os.replace(temp_path, self.cache_path)
+        except OSError as e:
+            print_debug(f"unable to cache topology in {self.cache_path}: {e}")
+
+    @staticmethod
+    @cache
+    def get():
+        return Topology.load()
+
+    def cpus(self, domains, indexes) -> CPUNodeSet:
+        # union of the CPUs of the given domain indexes, e.g. cpus(topology.l3_cpus, [1])
+        bits = 0
+        for n in indexes:
+            if 0 <= n < len(domains):
+                bits |= domains[n]
+        return CPUNodeSet._from_bits(bits)
+
+    def select(self, selector: str, indexes: NodeSet) -> CPUNodeSet:
+        # all CPUs in the given domains, e.g. select("L3", NodeSet("1")) for every thread sharing the
+        # second L3 cache
+        domains = getattr(self, Topology.selectors[selector])
+        if not indexes:
+            raise ValueError(f"no {selector} given")
+        missing = [n for n in indexes if n >= len(domains) or not domains[n]]
+        if missing:
+            raise ValueError(f"{selector} {NodeSet(missing).to_list_form()} does not exist")
+        return self.cpus(domains, indexes)
+
+
+if __name__ == "__main__":
+    t = Topology.scan()
+    print(t)
+    for cpu in range(t.cpu_count()):
+        print(f"CPU {cpu}: core {t.cpu_core[cpu]} die {t.cpu_die[cpu]} package {t.cpu_package[cpu]} "
+              f"L2 {t.cpu_l2[cpu]} L3 {t.cpu_l3[cpu]} node {t.cpu_node[cpu]}")
+    for node, distances in t.node_distances.items():
+        print(f"node {node}: cpus {CPUNodeSet._from_bits(t.node_cpus[node]).to_list_form()} "
+              f"distances {list(distances)}")
@@ -0,0 +1,58 @@
+import os
+from typing import Generator
+
+from vfio_isolate.nodeset import CPUNodeSet
+from vfio_isolate.output import print_debug
+
+
+class Workqueue:
+    base_path = "/sys/devices/virtual/workqueue"
+
+    def __init__(self, name: str = None):
+        # None is the cpumask all unbound workqueues are restricted to
+        self.name = name
+
+    def __repr__(self):
+        return f"Workqueue {self.name or '(all unbound)'}"
+
+    def __path(self, path: str = None):
+        elements = [Workqueue.base_path]
+        if self.name:
+            elements.append(self.name)
+        if path:
+            elements.append(path)
+        return "/".join(elements)
+
+    def exists(self):
+        return os.path.exists(self.__path("cpumask"))
+
+    def get_cpumask(self) -> CPUNodeSet:
+        # the kernel prints hex words without padding the first, e.g. "1" on a single CPU system
+        with open(self.__path("cpumask"), "r") as f:
+            return CPUNodeSet._from_bits(int(f.read().strip().replace(",", ""), 16))
+
+    def set_cpumask(self, cpus: CPUNodeSet):
+        try:
+            with open(self.__path("cpumask"), "w") as f:
+                f.write(cpus.to_mask_form(CPUNodeSet.possible_cpus().bits.bit_length()))
+            return True
+        except OSError as e:
+            print_debug(f"unable to set cpumask of {self} to CPUs {cpus}: {e.strerror}")
+            return False
+
+
+class Workqueues:
+
+    @classmethod
+    def all(cls) -> Generator[Workqueue, None, None]:
+        # the global cpumask first, followed by the workqueues visible in sysfs
+        yield Workqueue()
+        for entry in sorted(os.listdir(Workqueue.base_path)):
+            workqueue = Workqueue(entry)
+            if workqueue.exists():
+                yield workqueue
+
+
+if __name__ == "__main__":
+    for w in Workqueues.all():
+        print(f"{w}: {w.get_cpumask().to_list_form()}")